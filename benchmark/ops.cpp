@@ -9,6 +9,8 @@
 #include <iostream>
 #include <concepts>
 #include <random>
+#include <stdexcept>
+#include <string>
 #include <vector>
 
 #include <mpfr.h>
@@ -792,7 +794,11 @@ void benchmark_op3(
 }
 
 
-int main() {
+static void report_separator() {
+    std::cout << "---\n";
+}
+
+static void run_benchmarks() {
     const auto INPUT_CTX = mpfx::IEEE754Context(8, 32, mpfx::RM::RNE);
     const auto OUTPUT_CTX = mpfx::IEEE754Context(8, 16, mpfx::RM::RNE);
     constexpr size_t N = 10'000'000;
@@ -804,5 +810,40 @@ int main() {
     benchmark_op2<OP2::DIV>(INPUT_CTX, OUTPUT_CTX, N);
     benchmark_op1<OP1::SQRT>(INPUT_CTX, OUTPUT_CTX, N);
     benchmark_op3<OP3::FMA>(INPUT_CTX, OUTPUT_CTX, N);
+}
+
+
+static int usage(const char* prog) {
+    std::cerr << "Usage: " << prog << " [--iterations N]" << std::endl;
+    return 1;
+}
+
+
+int main(int argc, char* argv[]) {
+    // parse arguments
+    size_t iterations = 1;
+    if (argc == 3 && std::string(argv[1]) == "--iterations") {
+        const std::string arg = argv[2];
+        size_t pos = 0;
+        try {
+            iterations = std::stoul(arg, &pos);
+        } catch (const std::exception&) {
+            return usage(argv[0]);
+        }
+        if (pos != arg.size() || arg[0] == '-' || iterations == 0) {
+            return usage(argv[0]);
+        }
+    } else if (argc != 1) {
+        return usage(argv[0]);
+    }
+
+    // each iteration prints a CSV table; tables are separated by `---`
+    for (size_t i = 0; i < iterations; i++) {
+        if (i > 0) {
+            report_separator();
+        }
+        run_benchmarks();
+    }
+
     return 0;
 }
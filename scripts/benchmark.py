@@ -1,17 +1,27 @@
 import csv
+import gzip
+import json
+import os
 import pickle
 import subprocess
+import zlib
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError, BooleanOptionalAction
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import matplotlib.pyplot as plt
+from matplotlib.container import BarContainer
+from matplotlib.figure import Figure
+from matplotlib.text import Annotation
 import numpy as np
 
 REPO_ROOT = Path(__file__).parent.parent.resolve()
 BUILD_DIR = REPO_ROOT / "build"
+SOURCE_DIRS = ["benchmark", "cmake", "include", "src"]
 
 ROWS = [
     'add',
@@ -33,6 +43,8 @@ COLUMNS = [
     'mpfx_eft'
 ]
 
+ROW_INDEX = {op: i for i, op in enumerate(ROWS)}
+
 NAMES = {
     'mpfr': 'MPFR',
     'softfloat': 'SoftFloat',
@@ -44,35 +56,114 @@ NAMES = {
 }
 
 
+# separator line printed by `ops --iterations N` between per-iteration tables
+SEPARATOR = '---'
+
+# color gradient from light to dark blue, one per implementation
+_COLORS = plt.cm.Blues(np.linspace(0.4, 0.9, len(COLUMNS[1:])))
+_LEGEND_PATCHES = [plt.Rectangle((0, 0), 1, 1, fc=color, edgecolor='black', linewidth=0.5) for color in _COLORS]
+
+
 @dataclass
 class TaskConfig:
     task_id: int
     cache_dir: Path
+    iterations: list[int]
+    cpu: Optional[int] = None
+    keep_stderr: bool = False
+
+
+def _split_rows(rows: list[list[str]]):
+    # split into header, operation names, and a (ops x columns) table of times
+    headers = rows[0]
+    op_names = [row[0] for row in rows[1:]]
+    times = np.array([row[1:] for row in rows[1:]], dtype=np.float64)
+    return headers, op_names, times
 
 
 def benchmark_task(config: TaskConfig):
-    # run benchmark and capture output to parse as CSV
+    # run benchmark once for all iterations of this task and capture output to parse as CSV
     print(f"Running benchmark task {config.task_id}...")
     benchmark_path = BUILD_DIR / "benchmark" / "ops"
-    p = subprocess.run([str(benchmark_path)], capture_output=True, check=True)
-    output = p.stdout.decode()
-
-    # parse data as CSV
-    data: list[list[str]] = []
-    for row in csv.reader(output.splitlines()):
-        data.append([datum.strip() for datum in row])
-
-    # write raw output to cache
-    cache_file = config.cache_dir / f"raw_task_{config.task_id}.csv"
-    with cache_file.open('w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(data)
+    cmd = [str(benchmark_path), '--iterations', str(len(config.iterations))]
+
+    # parse data as CSV while it is streamed (fields are separated by ", "),
+    # splitting output into one table per iteration
+    tables: list[list[list[str]]] = [[]]
+    stderr = None if config.keep_stderr else subprocess.DEVNULL
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True, bufsize=-1) as p:
+        if config.cpu is not None:
+            # pin benchmark to a single CPU so parallel tasks do not compete for cores
+            os.sched_setaffinity(p.pid, {config.cpu})
+        for row in csv.reader(p.stdout, skipinitialspace=True):
+            if row == [SEPARATOR]:
+                tables.append([])
+            else:
+                tables[-1].append(row)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    assert len(tables) == len(config.iterations), f"expected {len(config.iterations)} tables, got {len(tables)}"
+
+    results = {}
+    for iteration, rows in zip(config.iterations, tables):
+        # write compressed raw output to cache
+        # (via a temporary file so an interrupted run never leaves a partial entry)
+        cache_file = config.cache_dir / f"raw_task_{iteration}.csv.gz"
+        tmp_file = cache_file.with_suffix('.tmp')
+        with gzip.open(tmp_file, 'wt', newline='', compresslevel=6) as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+        os.replace(tmp_file, cache_file)
+
+        results[iteration] = _split_rows(rows)
 
     print(f"Completed benchmark task {config.task_id}.")
-    return data
-
-
-def run_benchmarks(output_dir: Path, iterations: int, threads: int):
+    return results
+
+
+def _load_cached_task(iteration: int, cache_file: Path):
+    # read raw output of a previous run instead of re-running the benchmark;
+    # returns None (and removes the file) if the cached output is corrupt
+    print(f"Loading cached benchmark results from {cache_file}...")
+    try:
+        with gzip.open(cache_file, 'rt', newline='') as f:
+            rows = list(csv.reader(f, skipinitialspace=True))
+        return {iteration: _split_rows(rows)}
+    except (EOFError, OSError, zlib.error, csv.Error, ValueError, IndexError):
+        print(f"Discarding corrupt cached results {cache_file}.")
+        cache_file.unlink(missing_ok=True)
+        return None
+
+
+def _is_cache_valid(cache_file: Path) -> bool:
+    # cached output is stale if the benchmark binary was rebuilt after it was written
+    if not cache_file.exists() or cache_file.stat().st_size == 0:
+        return False
+    benchmark_path = BUILD_DIR / "benchmark" / "ops"
+    return not benchmark_path.exists() or cache_file.stat().st_mtime >= benchmark_path.stat().st_mtime
+
+
+def _merge_into(
+    sums: np.ndarray,
+    counts: np.ndarray,
+    data: tuple[list[str], list[str], np.ndarray]
+):
+    # accumulate the (ops x columns) table of a single iteration into running sums
+    headers, op_names, task_times = data
+    assert headers[1:] == COLUMNS, f"unexpected benchmark output columns: {headers[1:]} != {COLUMNS}"
+    op_idx = [ROW_INDEX[op_name] for op_name in op_names]
+    np.add.at(sums, op_idx, task_times)
+    np.add.at(counts, op_idx, 1)
+
+
+def run_benchmarks(
+    output_dir: Path,
+    iterations: int,
+    threads: int,
+    force: bool = False,
+    pin: bool = False,
+    keep_stderr: bool = False
+):
     cache_dir = output_dir / "cache"
     plot_dir = output_dir / "plots"
 
@@ -81,73 +172,112 @@ def run_benchmarks(output_dir: Path, iterations: int, threads: int):
     cache_dir.mkdir(exist_ok=True)
     plot_dir.mkdir(exist_ok=True)
 
+    # CPUs available for pinning benchmark tasks
+    if pin and not hasattr(os, 'sched_setaffinity'):
+        print("CPU pinning is not supported on this platform, ignoring --pin.")
+        pin = False
+    cpus = sorted(os.sched_getaffinity(0)) if pin else []
+    if pin and threads > len(cpus):
+        # sharing a core between pinned benchmarks is worse than not pinning at all
+        print(f"Only {len(cpus)} CPUs available for pinning, reducing threads from {threads} to {len(cpus)}.")
+        threads = len(cpus)
+
     # run benchmarks in parallel
     # output is
     #  header0, header1, header2, ...
     #  op_name, time1, time2, ...
-    results = []
-    with ProcessPoolExecutor(max_workers=threads) as executor:
-        configs: list[TaskConfig] = []
+    # each result is merged as soon as its task completes
+    sums = np.zeros((len(ROWS), len(COLUMNS)), dtype=np.float64)
+    counts = np.zeros((len(ROWS), 1), dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = []
+        pending: list[int] = []
         for i in range(iterations):
-            configs.append(TaskConfig(i, cache_dir))
-
-        futures = [executor.submit(benchmark_task, config) for config in configs]
-        for future in futures:
-            results.append(future.result())
-
-    # group first by operation, then by header1..N
-    # discard the header row
-    aggregated: dict[str, dict[str, list[float]]] = {}
-    for result in results:
-        headers = result[0]
-        assert headers[1:] == COLUMNS, f"unexpected benchmark output columns: {headers[1:]} != {COLUMNS}"
-        for row in result[1:]:
-            op_name = row[0]
-            if op_name not in aggregated:
-                table: dict[str, list[float]] = {}
-                for header, time in zip(headers[1:], row[1:]):
-                    table[header] = [float(time)]
-                aggregated[op_name] = table
+            # reuse raw output of a previous run of the current binary unless forced to re-run
+            # (loaded up front so corrupt entries can be re-run below)
+            cache_file = cache_dir / f"raw_task_{i}.csv.gz"
+            cached = _load_cached_task(i, cache_file) if not force and _is_cache_valid(cache_file) else None
+            if cached is not None:
+                for data in cached.values():
+                    _merge_into(sums, counts, data)
             else:
-                for header, time in zip(headers[1:], row[1:]):
-                    aggregated[op_name][header].append(float(time))
+                pending.append(i)
+
+        # split remaining iterations into one chunk per thread,
+        # each run by a single invocation of the binary
+        chunks = np.array_split(np.array(pending, dtype=int), threads)
+        groups = [chunk.tolist() for chunk in chunks if len(chunk) > 0]
+        for task_id, group in enumerate(groups):
+            cpu = cpus[task_id] if pin else None
+            futures.append(executor.submit(benchmark_task, TaskConfig(task_id, cache_dir, group, cpu, keep_stderr)))
+
+        for future in as_completed(futures):
+            results = future.result()
+            for data in results.values():
+                _merge_into(sums, counts, data)
+            del results
 
     print("Aggregated benchmark results.")
 
-    # compute average time
-    average_runtimes: dict[tuple[str, str], float] = {}
-    for op_name, table in aggregated.items():
-        for header, times in table.items():
-            avg_time = sum(times) / len(times)
-            average_runtimes[(op_name, header)] = avg_time
-
-    # write average runtimes to pickle
-    avg_runtime_file = cache_dir / "average_runtimes.pkl"
-    with avg_runtime_file.open('wb') as f:
-        pickle.dump(average_runtimes, f)
-
-    # compute average overhead over native
-    average_overheads: dict[tuple[str, str], float] = {}
-    for op_name, table in aggregated.items():
-        baseline_times = table['native']
-        baseline = sum(baseline_times) / len(baseline_times)
-        for header, times in table.items():
-            if header != 'native':
-                avg_time = sum(times) / len(times)
-                overhead = avg_time / baseline
-                average_overheads[(op_name, header)] = overhead
-
-    # write average overheads to pickle
-    avg_overhead_file = cache_dir / "average_overheads.pkl"
-    with avg_overhead_file.open('wb') as f:
-        pickle.dump(average_overheads, f)
-
-
-def report_overhead(output_dir: Path):
-    # load average overheads from pickle
-    avg_overhead_file = output_dir / "cache" / "average_overheads.pkl"
-    with avg_overhead_file.open('rb') as f:
-        average_overheads: dict[tuple[str, str], float] = pickle.load(f)
+    # compute average time and average overhead over native
+    assert counts.all(), f"no results for operations: {[op for op, n in zip(ROWS, counts[:, 0]) if n == 0]}"
+    avg = sums / counts
+    overhead = avg[:, 1:] / avg[:, 0:1]
+
+    # write average runtimes to JSON
+    average_runtimes: dict[tuple[str, str], float] = {
+        (ROWS[i], COLUMNS[j]): float(t) for (i, j), t in np.ndenumerate(avg)
+    }
+    _write_table(cache_dir / "average_runtimes.json", average_runtimes)
+
+    # write average overheads to JSON
+    average_overheads: dict[tuple[str, str], float] = {
+        (ROWS[i], COLUMNS[1 + j]): float(overhead[i, j]) for i, j in np.ndindex(overhead.shape)
+    }
+    _write_table(cache_dir / "average_overheads.json", average_overheads)
+
+    # the tables were rewritten, drop any previously loaded copies
+    _read_overheads.cache_clear()
+
+
+def _write_table(path: Path, table: dict[tuple[str, str], float]):
+    # stored as a list of [op, col, value] triples
+    data = [[op, col, value] for (op, col), value in table.items()]
+    path.write_text(json.dumps(data, allow_nan=False))
+
+
+def _overheads_file(output_dir: Path, legacy_pickle: bool = False) -> Path:
+    # optionally fall back to the pickle written by older versions of this script
+    # (opt-in since unpickling can execute arbitrary code)
+    cache_dir = output_dir / "cache"
+    json_file = cache_dir / "average_overheads.json"
+    legacy_file = cache_dir / "average_overheads.pkl"
+    if not json_file.exists() and legacy_file.exists():
+        if not legacy_pickle:
+            raise FileNotFoundError(f"{json_file} not found; pass --legacy-pickle to load {legacy_file}")
+        return legacy_file
+    return json_file
+
+
+def _load_overheads(path: str) -> dict[tuple[str, str], float]:
+    # shared by report_overhead and plot_overhead so the file is read once;
+    # keyed on mtime so a rewritten file is reloaded, and copied so callers
+    # cannot modify the cached table
+    return dict(_read_overheads(path, os.stat(path).st_mtime_ns))
+
+
+@lru_cache(maxsize=4)
+def _read_overheads(path: str, mtime_ns: int) -> dict[tuple[str, str], float]:
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    with open(path, 'r') as f:
+        return {(op, col): value for op, col, value in json.load(f)}
+
+
+def report_overhead(output_dir: Path, legacy_pickle: bool = False):
+    # load average overheads
+    average_overheads = _load_overheads(str(_overheads_file(output_dir, legacy_pickle)))
 
     print(f'{"op":<12}', end="")
     for col in COLUMNS[1:]:
@@ -161,80 +291,129 @@ def report_overhead(output_dir: Path):
             print(f'{overhead:>12.2f}', end="")
         print()
 
-def plot_overhead(output_dir: Path):
-    # load average overheads from pickle
-    avg_overhead_file = output_dir / "cache" / "average_overheads.pkl"
-    with avg_overhead_file.open('rb') as f:
-        average_overheads: dict[tuple[str, str], float] = pickle.load(f)
+# figure, bars, and value labels reused across calls to `plot_overhead`
+_FIG_CACHE: Optional[tuple[Figure, list[BarContainer], list[list[Annotation]]]] = None
 
-    plot_dir = output_dir / "plots"
-    plot_dir.mkdir(exist_ok=True)
 
-    # Create a color gradient from light to dark blue
-    n_colors = len(COLUMNS[1:])
-    colors = plt.cm.Blues(np.linspace(0.4, 0.9, n_colors))
-    
+def _get_fig() -> tuple[Figure, list[BarContainer], list[list[Annotation]]]:
+    global _FIG_CACHE
+    if _FIG_CACHE is not None:
+        return _FIG_CACHE
+
     # Create a single figure with subplots for all operations
     fig, axes = plt.subplots(2, 3, figsize=(18, 10))
     axes = axes.flatten()
-    
-    # Create a bar chart for each operation
+
+    # Create an (empty) bar chart for each operation
+    all_bars: list[BarContainer] = []
+    all_labels: list[list[Annotation]] = []
     for idx, op in enumerate(ROWS):
         ax: plt.Axes = axes[idx]
-        
-        # Get overheads for this operation
-        overheads = [average_overheads[(op, col)] for col in COLUMNS[1:]]
-        
+
         # Create bar chart with gradient colors
         x = np.arange(len(COLUMNS[1:]))
-        bars = ax.bar(x, overheads, color=colors, edgecolor='black', linewidth=0.5)
-        
+        bars = ax.bar(x, np.zeros(len(x)), color=_COLORS, edgecolor='black', linewidth=0.5)
+
         # Customize plot
         ax.set_title(f'{op.upper()}', fontsize=12)
         ax.set_xticks([])  # Remove x-axis ticks and labels
         ax.grid(axis='y', alpha=0.3, linestyle='--')
-        
-        # Add value labels on top of bars
-        for bar in bars:
-            height = bar.get_height()
-            ax.text(bar.get_x() + bar.get_width()/2., height,
-                   f'{height:.1f}x',
-                   ha='center', va='bottom', fontsize=10)
-    
+
+        all_bars.append(bars)
+        all_labels.append([])
+
     # Add common y-label for all subplots
     fig.supylabel('Overhead (relative to native)', fontsize=12)
-    
+
     # Create legend with implementation names
-    legend_patches = [plt.Rectangle((0, 0), 1, 1, fc=colors[i], edgecolor='black', linewidth=0.5) 
-                     for i in range(len(COLUMNS[1:]))]
     legend_labels = [NAMES[col] for col in COLUMNS[1:]]
-    fig.legend(legend_patches, legend_labels, loc='center', 
+    fig.legend(_LEGEND_PATCHES, legend_labels, loc='center',
               bbox_to_anchor=(0.5, -0.02), ncol=len(COLUMNS[1:]), frameon=True,
               fontsize=12, edgecolor='black')
-    
-    plt.suptitle('Performance Overhead by Operation', fontsize=16)
-    plt.tight_layout(rect=[0.015, 0.03, 1, 0.96])
-    
+
+    fig.suptitle('Performance Overhead by Operation', fontsize=16)
+
+    _FIG_CACHE = (fig, all_bars, all_labels)
+    return _FIG_CACHE
+
+
+def plot_overhead(output_dir: Path, legacy_pickle: bool = False):
+    # load average overheads
+    average_overheads = _load_overheads(str(_overheads_file(output_dir, legacy_pickle)))
+
+    plot_dir = output_dir / "plots"
+    plot_dir.mkdir(exist_ok=True)
+
+    # Update the bar chart of each operation
+    fig, all_bars, all_labels = _get_fig()
+    for op, bars, labels in zip(ROWS, all_bars, all_labels):
+        # Get overheads for this operation
+        overheads = [average_overheads[(op, col)] for col in COLUMNS[1:]]
+
+        # Update bar heights
+        for bar, height in zip(bars, overheads):
+            bar.set_height(height)
+
+        # Replace value labels on top of bars
+        ax = bars.patches[0].axes
+        for label in labels:
+            label.remove()
+        # (the container still holds the initial zero heights, so format explicitly)
+        labels[:] = ax.bar_label(bars, labels=[f'{height:.1f}x' for height in overheads], fontsize=10)
+        ax.relim()
+        ax.autoscale_view()
+
+    fig.tight_layout(rect=[0.015, 0.03, 1, 0.96])
+
     # Save combined plot
     plot_file = plot_dir / "overhead.png"
-    plt.savefig(plot_file, dpi=150, bbox_inches='tight')
-    plt.close()
-    
+    fig.savefig(plot_file, dpi=150, bbox_inches='tight')
+
     print(f"Saved plot: {plot_file}")
 
 
 
-def build_benchmarks():
+def _newest_source_mtime() -> float:
+    # sources and build files the benchmark binary depends on
+    files = [REPO_ROOT / "CMakeLists.txt"]
+    for source_dir in SOURCE_DIRS:
+        files.extend(p for p in (REPO_ROOT / source_dir).rglob('*') if p.is_file())
+    return max(p.stat().st_mtime for p in files)
+
+
+def build_benchmarks() -> bool:
+    # skip configure and build if the binary is newer than every source
+    benchmark_path = BUILD_DIR / "benchmark" / "ops"
+    if (BUILD_DIR / "CMakeCache.txt").exists() and benchmark_path.exists():
+        if benchmark_path.stat().st_mtime > _newest_source_mtime():
+            return False
+
     # Navigate to build directory and build benchmarks
     subprocess.run(["cmake", "-DBUILD_BENCHMARKS=ON", ".."], cwd=BUILD_DIR, check=True)
     subprocess.run(['make', '-j'], cwd=BUILD_DIR, check=True)
+    return True
+
+
+def _positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"expected a positive integer, got {value}")
+    if n < 1:
+        raise ArgumentTypeError(f"expected a positive integer, got {value}")
+    return n
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Benchmarking script for MPFX")
     parser.add_argument('output_dir', type=Path, help='Directory to save benchmark results.')
-    parser.add_argument('--iterations', type=int, default=1, help='Number of iterations for each benchmark test.')
-    parser.add_argument('--threads', type=int, default=1, help='Number of parallel processes to use for benchmarking.')
+    parser.add_argument('--iterations', type=_positive_int, default=1, help='Number of iterations for each benchmark test.')
+    parser.add_argument('--threads', type=int, default=1, help='Number of benchmarks to run in parallel.')
     parser.add_argument('--replot', action='store_true', help='Re-generate plots from existing benchmark data.')
+    parser.add_argument('--force', action='store_true', help='Re-run benchmarks even if cached results exist.')
+    parser.add_argument('--pin', action=BooleanOptionalAction, default=False, help='Pin each benchmark task to a distinct CPU (Linux only).')
+    parser.add_argument('--keep-stderr', action='store_true', help='Show stderr of the benchmark binary instead of discarding it.')
+    parser.add_argument('--legacy-pickle', action='store_true', help='Allow loading overheads from a trusted average_overheads.pkl written by older versions.')
     args = parser.parse_args()
 
     # arguments
@@ -242,23 +421,30 @@ if __name__ == "__main__":
     iterations: int = args.iterations
     threads: int = args.threads
     replot: bool = args.replot
+    force: bool = args.force
+    pin: bool = args.pin
+    keep_stderr: bool = args.keep_stderr
+    legacy_pickle: bool = args.legacy_pickle
 
     # log config
     print(f"Output Directory: {output_dir}")
     print(f"Iterations: {iterations}")
     print(f"Threads: {threads}")
+    print(f"Pin CPUs: {pin}")
 
     if not replot:
         # build benchmarks
         print('Building benchmark binaries...')
-        build_benchmarks()
-        print('Benchmark binaries built successfully.')
+        if build_benchmarks():
+            print('Benchmark binaries built successfully.')
+        else:
+            print('Benchmark binaries are up to date.')
 
         # Run benchmarks
-        run_benchmarks(output_dir, iterations, threads)
+        run_benchmarks(output_dir, iterations, threads, force, pin, keep_stderr)
 
     # Report overheads
-    report_overhead(output_dir)
+    report_overhead(output_dir, legacy_pickle)
 
     # Plot overhead
-    plot_overhead(output_dir)
+    plot_overhead(output_dir, legacy_pickle)